@@ -3,13 +3,35 @@
 
 import requests
 import json
+import csv
+import datetime
+import fcntl
+import itertools
+import multiprocessing
+import multiprocessing.connection
+import os
+import resource
+import socket
+import sqlite3
+import time
+import urllib.parse
+import argparse
 import base64
+import contextlib
 import pandas as pd
 import logging
 import hashlib
+import heapq
 from unidecode import unidecode
+import ijson
 from dotenv import dotenv_values
 
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
@@ -17,6 +39,43 @@ config = dotenv_values(".env")
 api_token = config["CKAN_API_KEY"]
 ckan_api_url = config["CKAN_API_URL"]
 
+# Quantidade de registros usada para descobrir as colunas quando o endpoint não declara "columns"
+CSV_SCHEMA_SAMPLE = 100
+
+MB = 1024 * 1024
+# Orçamento de memória do container e histórico de pico de cada job (endpoint, exercício)
+MEMORY_BUDGET = int(config.get("MEMORY_BUDGET_MB") or 768) * MB
+MAX_WORKERS = int(config.get("MAX_WORKERS") or 4)
+HISTORY_FILE = config.get("HISTORY_FILE") or "job-history.json"
+DEFAULT_JOB_MEMORY = 128 * MB
+MEMORY_MARGIN = 1.2
+# Medidas de um download completo, mantidas quando o probe pula o exercício
+FULL_RUN_STATS = ("peak_bytes", "duration", "download_bytes", "upload_bytes")
+
+# Bytes baixados pelo job atual (cada job roda no seu próprio processo)
+downloaded_bytes = 0
+
+# Parciais por exercício dos agregados declarados em "aggregates"
+AGGREGATES_DIR = config.get("AGGREGATES_DIR") or "aggregates"
+PUBLISHED_FILE = ".published"
+SPEC_FILE = ".spec"
+
+# Consulta barata (size=1) antes do download completo para pular exercícios sem mudança
+PROBE_CHANGES = config.get("PROBE_CHANGES") != "0"
+# Idade máxima do último download completo antes de ignorar o probe
+PROBE_MAX_AGE_DAYS = int(config.get("PROBE_MAX_AGE_DAYS") or 30)
+
+# Fila de jobs compartilhada entre máquinas (comandos "enqueue" e "worker")
+QUEUE_DB = config.get("QUEUE_DB") or "jobs.sqlite"
+LEASE_SECONDS = 600
+POLL_SECONDS = 15
+MAX_ATTEMPTS = 3
+
+# Agrupa todos os recursos de um pacote num único package_revise (CKAN >= 2.9)
+BATCH_UPLOADS = config.get("CKAN_BATCH_UPLOADS") == "1"
+# Limite de arquivos por package_revise: o corpo multipart é montado em memória no processo principal
+REVISE_MAX_BYTES = int(config.get("REVISE_MAX_MB") or 64) * MB
+
 def clean_servidor(filepath):
     d = pd.read_csv(filepath)
     del d['nome_servidor']
@@ -195,7 +254,14 @@ def check_package(package_name):
     resp = requests.get(f"{ckan_api_url}/api/3/action/package_show?id={package_name}")
     resp_dict = json.loads(resp.content)
     if resp_dict["success"]:
-        return {"package_id": resp_dict["result"]["id"]}
+        result = resp_dict["result"]
+        return {
+            "package_id": result["id"],
+            "name": result["name"],
+            "title": result.get("title"),
+            "notes": result.get("notes"),
+            "resources": {r["name"]: r["id"] for r in result.get("resources", [])}
+        }
     else:
         return False
 
@@ -244,87 +310,918 @@ def upsert_resource(api_token, resource_name, resource_url_name, package_id, fil
 #     else:
 #         return False
 
+def revise_package(api_token, package_name, uploads, metadata=None):
+    # Um único package_revise com todos os recursos do pacote: o CKAN reindexa o pacote só uma vez
+    request_data = {
+        "match__name": package_name
+    }
+    for key, value in (metadata or {}).items():
+        request_data[f"update__{key}"] = value
+
+    new_uploads = [u for u in uploads if not u["resource_id"]]
+    if new_uploads:
+        request_data["update__resources__extend"] = json.dumps([
+            {"name": u["resource_url_name"], "title": u["resource_name"]} for u in new_uploads
+        ])
+
+    headers = {
+      "Authorization": api_token
+    }
+
+    with contextlib.ExitStack() as stack:
+        files = []
+        for u in uploads:
+            if u["resource_id"]:
+                files.append((f'update__resources__{u["resource_id"]}__upload', stack.enter_context(open(u["filepath"], 'rb'))))
+        # Recursos novos entram no fim da lista, endereçados por índice negativo
+        for i, u in enumerate(new_uploads):
+            files.append((f'update__resources__{i - len(new_uploads)}__upload', stack.enter_context(open(u["filepath"], 'rb'))))
+
+        resultado = requests.post(f"{ckan_api_url}/api/action/package_revise",
+                                  headers = headers,
+                                  data = request_data,
+                                  files = files
+                                 )
+    resposta_dict = json.loads(resultado.content)
+    return resposta_dict
+
+def sanitize_field(value):
+    if isinstance(value, str):
+        return value.replace('\r\n', '')
+    return value
+
+def iter_records(resp):
+    global downloaded_bytes
+    # Lê os registros de "data" direto do socket, sem materializar o corpo inteiro
+    resp.raw.decode_content = True
+    yield from ijson.items(resp.raw, 'data.item', use_float=True)
+    downloaded_bytes += resp.raw.tell()
+
+def write_records_csv(records, filepath, columns=None):
+    records = iter(records)
+    head = []
+    if columns is None:
+        # A ordem das colunas vem dos primeiros registros, como fazia o pd.DataFrame
+        columns = []
+        for record in records:
+            head.append(record)
+            for key in record:
+                if key not in columns:
+                    columns.append(key)
+            if len(head) >= CSV_SCHEMA_SAMPLE:
+                break
+
+    columns = list(columns)
+    known = set(columns)
+    header_size = len(columns)
+    rows = 0
+    with open(filepath, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        for record in itertools.chain(head, records):
+            if rows == 0:
+                writer.writerow(columns)
+            # Chaves novas entram no fim; o cabeçalho é corrigido depois
+            for key in record:
+                if key not in known:
+                    known.add(key)
+                    columns.append(key)
+            writer.writerow([sanitize_field(record.get(c, '')) for c in columns])
+            rows += 1
+
+    if rows and len(columns) > header_size:
+        logger.warning(f"Colunas novas após os primeiros registros em {filepath}: {', '.join(columns[header_size:])}")
+        rewrite_csv_header(filepath, columns)
+    return rows
+
+def rewrite_csv_header(filepath, columns):
+    # Regrava o arquivo linha a linha com o cabeçalho completo, completando as linhas mais curtas
+    tmp = filepath + '.tmp'
+    with open(filepath, newline='', encoding='utf-8') as src, open(tmp, 'w', newline='', encoding='utf-8') as dst:
+        reader = csv.reader(src)
+        writer = csv.writer(dst)
+        next(reader)
+        writer.writerow(columns)
+        for row in reader:
+            writer.writerow(row + [''] * (len(columns) - len(row)))
+    os.replace(tmp, filepath)
+
 def fetch_data(endpoint, exercicio):
     filename = endpoint["filename"].replace("$exercio$", str(exercicio))
     filepath = '/tmp/' + filename
 
     # Verifica se o endpoint é "Gasto com pessoal" para buscar os 12 meses
     if endpoint["url_name"] == "gasto-com-pessoal":
-        all_data = []
-        for month in range(1, 13):  # De 1 a 12 para cada mês
-            headers = endpoint["headers"].copy()
-            headers["exercicio"] = str(exercicio)
+        def records():
+            for month in range(1, 13):  # De 1 a 12 para cada mês
+                headers = endpoint["headers"].copy()
+                headers["exercicio"] = str(exercicio)
+                headers["mesano"] = str(month)
+                logger.info(f"Consultando {endpoint['name']} para {exercicio}/{month}")
+                with requests.get(endpoint["url"], headers=headers, stream=True) as resp:
+                    found = False
+                    for record in iter_records(resp):
+                        found = True
+                        yield record
+                if not found:
+                    logger.warning(f"Nenhum dado encontrado para {exercicio}/{month}")
+    else:
+        # Comportamento original para outros endpoints
+        def records():
+            endpoint["headers"]["exercicio"] = str(exercicio)
+            with requests.get(endpoint["url"], headers=endpoint["headers"], stream=True) as resp:
+                yield from iter_records(resp)
+            logger.warning(f"Endpoint downloaded: {endpoint['name']} OK")
+
+    if not write_records_csv(records(), filepath, endpoint.get("columns")):
+        return False
+    return filepath
+
+def job_key(endpoint, exercicio):
+    return endpoint["filename"].replace("$exercio$", str(exercicio))
+
+def load_history():
+    if not os.path.exists(HISTORY_FILE):
+        return {}
+    try:
+        with open(HISTORY_FILE) as file:
+            return json.load(file)
+    except ValueError as ex:
+        logger.warning(f"Histórico {HISTORY_FILE} ilegível, começando do zero: {str(ex)}")
+        return {}
+
+def save_history(history):
+    tmp = f"{HISTORY_FILE}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as file:
+        json.dump(history, file, indent=2, sort_keys=True)
+    os.replace(tmp, HISTORY_FILE)
+
+@contextlib.contextmanager
+def locked_history():
+    # Vários processos na mesma máquina dividem o arquivo: lê, altera e grava sob o mesmo lock
+    with open(HISTORY_FILE + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        history = load_history()
+        yield history
+        save_history(history)
+
+def historical_value(history, endpoint, exercicio, field):
+    # Valor registrado do job; sem histórico, o maior valor dos outros anos do mesmo endpoint
+    entry = history.get(job_key(endpoint, exercicio))
+    if entry and field in entry:
+        return entry[field]
+    prefix = endpoint["filename"].split("$exercio$")[0]
+    values = [v[field] for k, v in history.items() if k.startswith(prefix) and field in v]
+    if values:
+        return max(values)
+    return None
+
+def estimate_memory(history, endpoint, exercicio):
+    peak = historical_value(history, endpoint, exercicio, "peak_bytes")
+    if peak is None:
+        return DEFAULT_JOB_MEMORY
+    return int(peak * MEMORY_MARGIN)
+
+def current_rss():
+    with open('/proc/self/statm') as file:
+        return int(file.read().split()[1]) * resource.getpagesize()
+
+def file_sha256(filepath):
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def to_number(values):
+    # Colunas que o pandas já leu como número não passam pela conversão de texto
+    if pd.api.types.is_numeric_dtype(values):
+        return values
+    # Aceita "1.234,56", "R$ 1.234,56" e "1.234" (milhar, sem decimais) no formato pt-BR
+    text = values.astype('string').str.replace('R$', '', regex=False).str.strip()
+    decimal_comma = text.str.contains(',', regex=False, na=False)
+    thousands_only = text.str.fullmatch(r'-?\d{1,3}(\.\d{3})+', na=False)
+    pt_br = decimal_comma | thousands_only
+    text = text.where(~pt_br, text.str.replace('.', '', regex=False).str.replace(',', '.', regex=False))
+    return pd.to_numeric(text, errors='coerce')
+
+def aggregate_spec_hash(agg):
+    spec = {"group_by": agg["group_by"], "sum": agg.get("sum", [])}
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+def prepare_aggregates(targets):
+    # Mudou group_by/sum: os parciais antigos não combinam com os novos e são descartados
+    for e, package_id in targets:
+        for agg in e["aggregates"]:
+            agg_dir = os.path.join(AGGREGATES_DIR, agg["name"])
+            spec_path = os.path.join(agg_dir, SPEC_FILE)
+            spec_hash = aggregate_spec_hash(agg)
+            if os.path.exists(spec_path):
+                with open(spec_path) as file:
+                    if file.read() == spec_hash:
+                        continue
+            if os.path.isdir(agg_dir):
+                for f in os.listdir(agg_dir):
+                    os.remove(os.path.join(agg_dir, f))
+            os.makedirs(agg_dir, exist_ok=True)
+            with open(spec_path, 'w') as file:
+                file.write(spec_hash)
+
+def has_partial(agg, year):
+    # Um exercício ignorado (colunas ausentes, valores inválidos) também conta como calculado
+    agg_dir = os.path.join(AGGREGATES_DIR, agg["name"])
+    return os.path.exists(os.path.join(agg_dir, f"{year}.csv")) or os.path.exists(os.path.join(agg_dir, f"{year}.skipped"))
+
+def aggregate_year(e, year, filepath, aggs):
+    d = pd.read_csv(filepath)
+    for agg in aggs:
+        # Um agregado com problema não afeta os outros nem o upload do CSV
+        try:
+            aggregate_one(agg, year, d)
+        except Exception as ex:
+            logger.warning(f"Error aggregating {agg['name']} in {year}: {str(ex)}")
+
+def aggregate_one(agg, year, d):
+    agg_dir = os.path.join(AGGREGATES_DIR, agg["name"])
+    partial_path = os.path.join(agg_dir, f"{year}.csv")
+    skipped_path = os.path.join(agg_dir, f"{year}.skipped")
+    # Um exercício ignorado não pode deixar no resumo o parcial de uma execução anterior
+    for path in (partial_path, skipped_path):
+        if os.path.exists(path):
+            os.remove(path)
+    os.makedirs(agg_dir, exist_ok=True)
+
+    sums = agg.get("sum", [])
+    overlap = set(agg["group_by"]) & set(sums)
+    missing = [c for c in agg["group_by"] + sums if c not in d.columns]
+    if overlap:
+        reason = f"{sorted(overlap)} em group_by e sum"
+    elif missing:
+        reason = f"colunas ausentes {missing}"
+    else:
+        numbers = d[sums].apply(to_number)
+        # Valor preenchido que não virou número: melhor não publicar do que publicar soma errada
+        invalid = [c for c in sums if (numbers[c].isna() & d[c].notna() & (d[c].astype('string').str.strip() != '')).any()]
+        reason = f"valores não numéricos em {invalid}" if invalid else None
+
+    if reason:
+        logger.warning(f"Agregado {agg['name']} ignorado em {year}: {reason}")
+        open(skipped_path, 'w').close()
+        return
+
+    values = d[agg["group_by"]].join(numbers)
+    grouped = values.groupby(agg["group_by"], dropna=False)
+    partial = grouped[sums].sum() if sums else pd.DataFrame(index=grouped.size().index)
+    partial["registros"] = grouped.size()
+    partial = partial.reset_index()
+    partial.insert(0, "exercicio", year)
+
+    partial.to_csv(partial_path, index=False)
+
+def partials_signature(agg_dir):
+    return [[f, os.stat(os.path.join(agg_dir, f)).st_mtime_ns] for f in sorted(os.listdir(agg_dir)) if f.endswith('.csv')]
+
+def mark_published(agg_dir, signature):
+    with open(os.path.join(agg_dir, PUBLISHED_FILE), 'w') as file:
+        json.dump(signature, file)
+
+def build_aggregates(e):
+    # Junta os parciais de cada exercício num único resumo de todos os anos, se eles mudaram
+    # desde a última publicação confirmada pelo CKAN
+    built = []
+    for agg in e["aggregates"]:
+        agg_dir = os.path.join(AGGREGATES_DIR, agg["name"])
+        if not os.path.isdir(agg_dir):
+            continue
+        signature = partials_signature(agg_dir)
+        published_path = os.path.join(agg_dir, PUBLISHED_FILE)
+        if os.path.exists(published_path):
+            with open(published_path) as file:
+                if json.load(file) == signature:
+                    continue
+        if not signature:
+            continue
+        partials = [pd.read_csv(os.path.join(agg_dir, f)) for f, mtime in signature]
+        summary = pd.concat(partials, ignore_index=True).sort_values(["exercicio"] + agg["group_by"])
+        filepath = '/tmp/' + agg["name"] + '.csv'
+        summary.to_csv(filepath, index=False)
+        built.append({
+            "resource_url_name": agg["name"],
+            "resource_name": agg["title"],
+            "filepath": filepath,
+            "published": (agg_dir, signature)
+        })
+    return built
+
+def probe_url(url):
+    # Mesma listagem com um único registro; None se a URL não for paginada
+    parts = urllib.parse.urlsplit(url)
+    query = urllib.parse.parse_qs(parts.query)
+    if "size" not in query:
+        return None
+    query["page"] = ["1"]
+    query["size"] = ["1"]
+    return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(query, doseq=True)))
+
+def probe_fingerprint(endpoint, exercicio):
+    global downloaded_bytes
+    url = probe_url(endpoint["url"])
+    if url is None:
+        return None
+
+    # A resposta com size=1 traz o total de registros e o primeiro deles
+    months = range(1, 13) if months_of(endpoint) == 12 else [None]
+    digest = hashlib.sha256()
+    for month in months:
+        headers = endpoint["headers"].copy()
+        headers["exercicio"] = str(exercicio)
+        if month:
             headers["mesano"] = str(month)
-            logger.info(f"Consultando {endpoint['name']} para {exercicio}/{month}")
-            resp = requests.get(endpoint["url"], headers=headers)
-            resp_data = json.loads(resp.content)
-            if "data" in resp_data and resp_data["data"]:
-                all_data.extend(resp_data["data"])
+        with requests.get(url, headers=headers, stream=True) as resp:
+            resp.raise_for_status()
+            body = resp.content
+            # Bytes recebidos (comprimidos), a mesma conta de iter_records
+            downloaded_bytes += resp.raw.tell()
+        digest.update(json.dumps(json_loads(body), sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+def is_closed(exercicio):
+    return exercicio < datetime.date.today().year
+
+def should_probe(endpoint, exercicio):
+    # O exercício corrente ainda recebe correções em qualquer registro: sempre baixa completo
+    return PROBE_CHANGES and is_closed(exercicio) and probe_url(endpoint["url"]) is not None
+
+def upload_year(e, year, package_id, previous=None):
+    previous = previous or {}
+    result = {"upload": None}
+    fingerprint = None
+    # Agregados sem parcial deste exercício (novos ou com spec alterada) exigem o download completo
+    pending_aggs = [agg for agg in e.get("aggregates", []) if not has_partial(agg, year)]
+
+    try:
+        if should_probe(e, year) and not pending_aggs:
+            fingerprint = probe_fingerprint(e, year)
+            # O probe só vê o total e o primeiro registro: de tempos em tempos baixa completo mesmo assim
+            fresh = time.time() - previous.get("downloaded_at", 0) < PROBE_MAX_AGE_DAYS * 86400
+            if fingerprint and fingerprint == previous.get("fingerprint") and fresh:
+                logger.warning(f"No changes for {e['name']} in {year}, skipping download")
+                result.update(skipped=True, fingerprint=fingerprint, downloaded_at=previous["downloaded_at"])
+                if "sha256" in previous:
+                    result["sha256"] = previous["sha256"]
+                return result
+    except Exception as ex:
+        logger.warning(f"Error probing data for {e['name']} in {year}: {str(ex)}")
+
+    logger.warning(f"Download the data for {e['url']} in {year}")
+
+    try:
+        filepath = fetch_data(e, year)
+
+        # Upload the resource
+        if filepath:
+            resource_url_name = unidecode(f'{e["filename"]}{year}')
+            resource_url_name = resource_url_name.replace('$exercio$.csv', '')
+
+            if 'process' in e:
+                e['process'](filepath)
+            result["upload_bytes"] = os.path.getsize(filepath)
+
+            # No modo em lote o upload fica para o package_revise do pacote inteiro
+            # O fingerprint vai junto e só entra no histórico quando o package_revise confirmar
+            if BATCH_UPLOADS:
+                result["upload"] = {
+                    "key": job_key(e, year),
+                    "resource_url_name": resource_url_name,
+                    "resource_name": e["name"],
+                    "filepath": filepath,
+                    "confirmed": {"fingerprint": fingerprint, "downloaded_at": time.time()}
+                }
+            else:
+                resource = check_resource(resource_url_name)
+            
+                if resource:
+                    resp = upsert_resource(api_token, e["name"], resource_url_name, package_id, filepath, resource["resource_id"])
+                else:
+                    resp = upsert_resource(api_token, e["name"], resource_url_name, package_id, filepath)
+
+                # O fingerprint só vale como referência depois que o upload deu certo
+                if resp.get("success"):
+                    result.update(fingerprint=fingerprint, downloaded_at=time.time())
+    except Exception as ex:
+        logger.warning(f"Error downloading data for {e['name']} in {year}: {str(ex)}")
+        return result
+
+    # Depois do upload: recalcula todos os parciais do exercício quando o arquivo mudou,
+    # senão só os que ainda faltam
+    if filepath and 'aggregates' in e:
+        try:
+            sha256 = file_sha256(filepath)
+            aggs = e["aggregates"] if sha256 != previous.get("sha256") else pending_aggs
+            if aggs:
+                aggregate_year(e, year, filepath, aggs)
+            result["sha256"] = sha256
+        except Exception as ex:
+            logger.warning(f"Error aggregating {e['name']} in {year}: {str(ex)}")
+    return result
+
+def months_of(endpoint):
+    return 12 if endpoint["url_name"] == "gasto-com-pessoal" else 1
+
+def run_job(e, year, package_id, previous, conn):
+    # Roda num processo filho: o pico de RSS medido aqui é só deste job
+    start_rss = current_rss()
+    started = time.time()
+    result = upload_year(e, year, package_id, previous)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    stats = {
+        "peak_bytes": max(peak_rss - start_rss, 0),
+        "duration": round(time.time() - started, 2),
+        "download_bytes": downloaded_bytes
+    }
+    if result.get("skipped"):
+        # Só houve o probe: mantém as medidas do último download completo
+        stats.update((k, previous[k]) for k in FULL_RUN_STATS if k in previous)
+    conn.send(dict(result, **stats))
+    conn.close()
+
+def spawn_job(ctx, e, year, package_id, previous):
+    recv_conn, send_conn = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=run_job, args=(e, year, package_id, previous, send_conn))
+    proc.start()
+    send_conn.close()
+    return proc, recv_conn
+
+def collect_job(proc, recv_conn):
+    # Devolve o resultado do filho, ou None se ele morreu sem responder
+    proc.join()
+    message = recv_conn.recv() if recv_conn.poll() else None
+    recv_conn.close()
+    return message
+
+def run_jobs(jobs):
+    history = load_history()
+    ctx = multiprocessing.get_context('fork')
+    budget = MEMORY_BUDGET - current_rss()
+
+    # Os maiores primeiro; os pequenos preenchem o orçamento que sobrar
+    pending = sorted(
+        ((estimate_memory(history, e, year), e, year, package_id) for e, year, package_id in jobs),
+        key=lambda job: job[0],
+        reverse=True
+    )
+    running = {}
+    in_use = 0
+    results = []
+    # resource_create/patch regravam o pacote inteiro: dois jobs do mesmo pacote em paralelo perdem recursos
+    busy_packages = set()
+
+    while pending or running:
+        for job in list(pending):
+            if len(running) >= MAX_WORKERS:
+                break
+            estimate, e, year, package_id = job
+            # Um job maior que o orçamento só roda sozinho
+            if in_use + estimate > budget and running:
+                continue
+            if not BATCH_UPLOADS and package_id in busy_packages:
+                continue
+            pending.remove(job)
+            proc, recv_conn = spawn_job(ctx, e, year, package_id, history.get(job_key(e, year)))
+            running[proc.sentinel] = (proc, recv_conn, estimate, e, year, package_id)
+            in_use += estimate
+            busy_packages.add(package_id)
+            logger.info(f"Job {job_key(e, year)} admitido ({estimate // MB} MB estimados, {in_use // MB}/{budget // MB} MB em uso)")
+
+        for sentinel in multiprocessing.connection.wait(list(running)):
+            proc, recv_conn, estimate, e, year, package_id = running.pop(sentinel)
+            message = collect_job(proc, recv_conn)
+            in_use -= estimate
+            busy_packages.discard(package_id)
+            key = job_key(e, year)
+            if message:
+                results.append((e, package_id, message.pop("upload")))
+                logger.info(f"Job {key} terminou com pico de {message['peak_bytes'] // MB} MB")
             else:
-                logger.warning(f"Nenhum dado encontrado para {exercicio}/{month}")
-
-        if not all_data:
-            return False
-        
-        df = pd.DataFrame(all_data)
-        df = df.replace('\r\n', '', regex=True)
-        df.to_csv(filepath, index=False)
-        return filepath
+                # Processo morto sem resposta (provável OOM): na próxima execução ele roda sozinho
+                message = {"peak_bytes": budget, "killed": True}
+                logger.warning(f"Job {key} terminou sem resultado (exit code {proc.exitcode})")
+            with locked_history() as history:
+                history[key] = message
+
+    return results
+
+def revise_batches(uploads):
+    # O requests monta o corpo multipart inteiro em memória: cada package_revise leva no máximo
+    # REVISE_MAX_BYTES de arquivos (um arquivo maior vai sozinho). Cada chamada a mais custa uma reindexação
+    batches = []
+    size = 0
+    for u in uploads:
+        u_size = os.path.getsize(u["filepath"])
+        if not batches or size + u_size > REVISE_MAX_BYTES:
+            batches.append([])
+            size = 0
+        batches[-1].append(u)
+        size += u_size
+    return batches or [[]]
+
+def revise_key(url_name):
+    return f"package_revise:{url_name}"
+
+def upload_packages(packages, results):
+    uploads = {}
+    for e, package_id, upload in results:
+        if upload:
+            uploads.setdefault(package_id, []).append(upload)
+
+    for package_id in uploads.keys() - {p["package_id"] for p in packages.values()}:
+        logger.warning(f"Uploads descartados: pacote {package_id or '(não criado)'} indisponível")
+
+    for package in packages.values():
+        package_uploads = uploads.get(package["package_id"], [])
+        for u in package_uploads:
+            u["resource_id"] = package["resources"].get(u["resource_url_name"], '')
+        if not package_uploads and not package["metadata"]:
+            continue
+
+        metadata = package["metadata"]
+        revise_start = time.time()
+        for batch in revise_batches(package_uploads):
+            # Uma falha (inclusive uma página de erro que não é JSON, como um 413 do proxy) afeta só este lote
+            try:
+                resp = revise_package(api_token, package["name"], batch, metadata)
+                ok, error = resp.get("success", False), resp.get("error")
+            except Exception as ex:
+                ok, error = False, str(ex)
+            if not ok:
+                # Sem o fingerprint esses anos são baixados de novo na próxima execução
+                logger.warning(f"Error revising package {package['name']}: {error}")
+                continue
+            metadata = None
+
+            with locked_history() as history:
+                for u in batch:
+                    if "key" in u:
+                        history.setdefault(u["key"], {}).update(u["confirmed"])
+            for u in batch:
+                if "published" in u:
+                    mark_published(*u["published"])
+
+        # O --plan soma este tempo ao caminho crítico do pacote
+        with locked_history() as history:
+            history[revise_key(package["url_name"])] = {"revise_duration": time.time() - revise_start}
+
+def publish_aggregates(targets, results):
+    # Um resumo que falhou continua diferente do último publicado e é reenviado na próxima execução
+    for e, package_id in targets:
+        for upload in build_aggregates(e):
+            if BATCH_UPLOADS:
+                results.append((e, package_id, upload))
+                continue
+            try:
+                resource = check_resource(upload["resource_url_name"])
+                if resource:
+                    resp = upsert_resource(api_token, upload["resource_name"], upload["resource_url_name"], package_id, upload["filepath"], resource["resource_id"])
+                else:
+                    resp = upsert_resource(api_token, upload["resource_name"], upload["resource_url_name"], package_id, upload["filepath"])
+                if resp.get("success"):
+                    mark_published(*upload["published"])
+                else:
+                    logger.warning(f"Error uploading aggregate {upload['resource_url_name']}: {resp.get('error')}")
+            except Exception as ex:
+                logger.warning(f"Error uploading aggregate {upload['resource_url_name']}: {str(ex)}")
+
+def open_queue():
+    # Sem WAL: o banco pode ficar num sistema de arquivos compartilhado entre as máquinas
+    conn = sqlite3.connect(QUEUE_DB, timeout=60, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            key TEXT PRIMARY KEY,
+            endpoint TEXT NOT NULL,
+            exercicio INTEGER NOT NULL,
+            package_id TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            worker TEXT,
+            lease_until REAL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            result TEXT,
+            updated REAL
+        )
+    """)
+    return conn
+
+def enqueue_jobs(conn, jobs):
+    # Jobs com lease ativo continuam com o worker atual
+    for e, year, package_id in jobs:
+        conn.execute("""
+            INSERT INTO jobs (key, endpoint, exercicio, package_id, updated) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET
+                package_id = excluded.package_id, status = 'pending', worker = NULL,
+                lease_until = NULL, attempts = 0, updated = excluded.updated
+            WHERE status != 'leased'
+        """, (job_key(e, year), e["filename"], year, package_id, time.time()))
+
+def lease_job(conn, worker):
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("""
+            UPDATE jobs SET status = 'failed', worker = NULL, lease_until = NULL, updated = ?
+            WHERE status = 'leased' AND lease_until < ? AND attempts >= ?
+        """, (now, now, MAX_ATTEMPTS))
+        # Leases vencidos são de workers que caíram e voltam para a fila. Workers sobem cada
+        # recurso direto, então um pacote com job em andamento fica para depois
+        job = conn.execute("""
+            SELECT * FROM jobs
+            WHERE (status = 'pending' OR (status = 'leased' AND lease_until < ?)) AND attempts < ?
+                AND package_id NOT IN (SELECT package_id FROM jobs WHERE status = 'leased' AND lease_until >= ?)
+            ORDER BY attempts, key LIMIT 1
+        """, (now, MAX_ATTEMPTS, now)).fetchone()
+        if job:
+            conn.execute("""
+                UPDATE jobs SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1, updated = ?
+                WHERE key = ?
+            """, (worker, now + LEASE_SECONDS, now, job["key"]))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return job
+
+def heartbeat(conn, key, worker):
+    now = time.time()
+    cur = conn.execute("""
+        UPDATE jobs SET lease_until = ?, updated = ? WHERE key = ? AND worker = ? AND status = 'leased'
+    """, (now + LEASE_SECONDS, now, key, worker))
+    return cur.rowcount == 1
+
+def finish_job(conn, key, worker, result):
+    # Só o dono do lease registra o resultado: cada job é concluído no máximo uma vez
+    if result is None:
+        cur = conn.execute("""
+            UPDATE jobs SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END,
+                worker = NULL, lease_until = NULL, updated = ?
+            WHERE key = ? AND worker = ? AND status = 'leased'
+        """, (MAX_ATTEMPTS, time.time(), key, worker))
     else:
-        # Comportamento original para outros endpoints
-        endpoint["headers"]["exercicio"] = str(exercicio)
-        resp = requests.get(endpoint["url"], headers=endpoint["headers"])
-        logger.warning(f"Endpoint downloaded: {endpoint['name']} OK")
-        resp_data = json.loads(resp.content)
-        filepath = '/tmp/' + filename
-        file = open(filepath, 'wb')
-
-        if "data" in resp_data:
-            data_list = resp_data.get("data", [])
-            df = pd.DataFrame(data_list)
-            df = df.replace('\r\n', '', regex=True)
-            df.to_csv(filepath, index=False)
-            return filepath
-        else:
-            return False
-
-def main():
+        cur = conn.execute("""
+            UPDATE jobs SET status = 'done', result = ?, lease_until = NULL, updated = ?
+            WHERE key = ? AND worker = ? AND status = 'leased'
+        """, (json.dumps(result), time.time(), key, worker))
+    return cur.rowcount == 1
+
+def open_jobs(conn):
+    return conn.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('pending', 'leased')").fetchone()[0]
+
+def work(worker):
+    global BATCH_UPLOADS
+    # Cada worker sobe os próprios arquivos: o /tmp de uma máquina não é visto pelas outras
+    BATCH_UPLOADS = False
+
+    by_filename = {e["filename"]: e for endpoints in memory_api_endpoints.values() for e in endpoints["endpoints"]}
+    conn = open_queue()
+    ctx = multiprocessing.get_context('fork')
+
+    while True:
+        job = lease_job(conn, worker)
+        if job is None:
+            if not open_jobs(conn):
+                break
+            time.sleep(POLL_SECONDS)
+            continue
+
+        key = job["key"]
+        e = by_filename.get(job["endpoint"])
+        if e is None:
+            logger.warning(f"Job {key} aponta para um endpoint desconhecido: {job['endpoint']}")
+            finish_job(conn, key, worker, None)
+            continue
+
+        logger.info(f"Worker {worker} pegou o job {key} (tentativa {job['attempts'] + 1})")
+        # O resultado anterior traz o sha256 e o fingerprint usados para pular anos sem mudança
+        previous = json.loads(job["result"]) if job["result"] else None
+        proc, recv_conn = spawn_job(ctx, e, job["exercicio"], job["package_id"], previous)
+        lost = False
+        while proc.is_alive():
+            proc.join(LEASE_SECONDS / 3)
+            if proc.is_alive() and not heartbeat(conn, key, worker):
+                # Outro worker já pode ter pego o job: dois uploads do mesmo arquivo não podem correr juntos
+                logger.warning(f"Worker {worker} perdeu o lease do job {key}; interrompendo")
+                proc.terminate()
+                lost = True
+                break
+        message = collect_job(proc, recv_conn)
+        if lost:
+            continue
+
+        if message:
+            message.pop("upload")
+            with locked_history() as history:
+                history[key] = message
+        if not finish_job(conn, key, worker, message):
+            logger.warning(f"Resultado do job {key} descartado: o lease não é mais de {worker}")
+
+def expand_jobs(url_names=None, exercicios=None):
+    # Lista concreta de (organização, endpoint, exercício), sem consultar a rede
+    jobs = []
+    seen = set()
     for endpoints in memory_api_endpoints.values():
-        organization = endpoints["organization"]
         for e in endpoints["endpoints"]:
+            if url_names and e["url_name"] not in url_names:
+                continue
+            for year in e["headers"]["exercicio"]:
+                if exercicios and year not in exercicios:
+                    continue
+                # Dois jobs com o mesmo arquivo de saída sobrescreveriam um ao outro
+                key = job_key(e, year)
+                if key in seen:
+                    logger.warning(f"Job duplicado ignorado: {e['name']} ({key})")
+                    continue
+                seen.add(key)
+                jobs.append((endpoints["organization"], e, year))
+    return jobs
+
+def plan_jobs(url_names=None, exercicios=None):
+    jobs = []
+    packages = {}
+    aggregate_targets = []
+    package_ids = {}
+    for organization, e, year in expand_jobs(url_names, exercicios):
+        if id(e) not in package_ids:
             # Check package exist
             package = check_package(e["url_name"])
     
             package_id = ''
+            metadata = {}
             if not package:
                 resp = create_package(api_token, organization, e["name"], e["url_name"], e["notes"])
                 if resp["success"]:
                     package_id = resp["result"]["id"]
+                    package = {"package_id": package_id, "name": resp["result"]["name"], "resources": {}}
             else:
                 package_id = package["package_id"]
-    
-            # Get the data
-            for year in e["headers"]["exercicio"]:
-                logger.warning(f"Download the data for {e['url']} in {year}")
+                metadata = {k: v for k, v in (("title", e["name"]), ("notes", e["notes"])) if package[k] != v}
 
-                try:
-                    filepath = fetch_data(e, year)
+            if package and BATCH_UPLOADS:
+                packages.setdefault(package_id, dict(package, url_name=e["url_name"], metadata={}))["metadata"].update(metadata)
     
-                    # Upload the resource
-                    if filepath:
-                        resource_url_name = unidecode(f'{e["filename"]}{year}')
-                        resource_url_name = resource_url_name.replace('$exercio$.csv', '')
-                        resource = check_resource(resource_url_name)
-
-                        if 'process' in e:
-                            e['process'](filepath)
-                    
-                        if resource:
-                            resp = upsert_resource(api_token, e["name"], resource_url_name, package_id, filepath, resource["resource_id"])
-                        else:
-                            resp = upsert_resource(api_token, e["name"], resource_url_name, package_id, filepath)
-                except Exception as ex:
-                    logger.warning(f"Error downloading data for {e['name']} in {year}: {str(ex)}")
+            if 'aggregates' in e:
+                aggregate_targets.append((e, package_id))
+
+            package_ids[id(e)] = package_id
+
+        jobs.append((e, year, package_ids[id(e)]))
+
+    return jobs, packages, aggregate_targets
+
+def enqueue(url_names=None, exercicios=None, wait=False):
+    jobs, packages, aggregate_targets = plan_jobs(url_names, exercicios)
+    prepare_aggregates(aggregate_targets)
+    conn = open_queue()
+    enqueue_jobs(conn, jobs)
+    logger.info(f"{len(jobs)} jobs enfileirados em {QUEUE_DB}")
+    if not wait:
+        return
+
+    while open_jobs(conn):
+        # Lease, heartbeat e conclusão atualizam "updated": parado por mais de um lease, não há worker vivo
+        last_update = conn.execute("SELECT MAX(updated) FROM jobs").fetchone()[0]
+        if time.time() - last_update > LEASE_SECONDS:
+            logger.warning(f"Nenhum worker ativo em {QUEUE_DB} há mais de {LEASE_SECONDS} s; agregados não publicados")
+            return
+        time.sleep(POLL_SECONDS)
+
+    # Os agregados dependem de AGGREGATES_DIR também estar no sistema de arquivos compartilhado
+    results = []
+    publish_aggregates(aggregate_targets, results)
+
+    if BATCH_UPLOADS:
+        upload_packages(packages, results)
+
+def simulate_schedule(jobs):
+    # Mesma admissão de run_jobs, com as durações do histórico no lugar dos processos
+    budget = MEMORY_BUDGET - current_rss()
+    pending = sorted(jobs, key=lambda job: job["memory"], reverse=True)
+    running = []
+    now = 0
+    in_use = 0
+    busy_packages = set()
+    while pending or running:
+        for job in list(pending):
+            if len(running) >= MAX_WORKERS:
+                break
+            if in_use + job["memory"] > budget and running:
+                continue
+            if not BATCH_UPLOADS and job["package"] in busy_packages:
+                continue
+            pending.remove(job)
+            heapq.heappush(running, (now + (job["duration"] or 0), job["memory"], job["package"]))
+            in_use += job["memory"]
+            busy_packages.add(job["package"])
+        now, memory, package = heapq.heappop(running)
+        in_use -= memory
+        busy_packages.discard(package)
+    return now
+
+def format_mb(value):
+    return '?' if value is None else f"{value / MB:.1f}"
+
+def plan(url_names=None, exercicios=None):
+    history = load_history()
+    jobs = []
+    for organization, e, year in expand_jobs(url_names, exercicios):
+        months = months_of(e)
+        probe = months if should_probe(e, year) else 0
+        entry = history.get(job_key(e, year), {})
+        jobs.append({
+            "key": job_key(e, year),
+            "package": e["url_name"],
+            # probe + download por mês; fora do modo em lote, resource_search + resource_create/patch
+            "requests": probe + months + (0 if BATCH_UPLOADS else 2),
+            "download_bytes": historical_value(history, e, year, "download_bytes"),
+            "upload_bytes": historical_value(history, e, year, "upload_bytes"),
+            "duration": historical_value(history, e, year, "duration"),
+            "memory": estimate_memory(history, e, year),
+            "skipped": entry.get("skipped", False)
+        })
+
+    if not jobs:
+        print("Nenhum job para os filtros informados")
+        return
+
+    # Um package_show por pacote e, no modo em lote, um package_revise; fora dele, cada
+    # agregado é um resource_search + resource_create/patch
+    packages = {job["package"] for job in jobs}
+    aggregates = sum(len(e.get("aggregates", [])) for e in {id(e): e for o, e, y in expand_jobs(url_names, exercicios)}.values())
+    package_requests = len(packages) * (2 if BATCH_UPLOADS else 1) + (0 if BATCH_UPLOADS else 2 * aggregates)
+
+    print(f"{'job':<40} {'req':>4} {'down MB':>9} {'up MB':>9} {'dur s':>8} {'mem MB':>8}  último")
+    for job in jobs:
+        duration = '?' if job["duration"] is None else f"{job['duration']:.1f}"
+        last = "sem mudança" if job["skipped"] else ""
+        print(f"{job['key']:<40} {job['requests']:>4} {format_mb(job['download_bytes']):>9} "
+              f"{format_mb(job['upload_bytes']):>9} {duration:>8} {job['memory'] / MB:>8.1f}  {last}")
+
+    unknown = [job for job in jobs if job["duration"] is None]
+    by_package = {}
+    for job in jobs:
+        by_package.setdefault(job["package"], []).append(job)
+    revise = {package: history.get(revise_key(package), {}).get("revise_duration") for package in by_package}
+
+    def package_path(package):
+        durations = [job["duration"] or 0 for job in by_package[package]]
+        if BATCH_UPLOADS:
+            # Os anos rodam em paralelo e o pacote termina com o package_revise
+            return max(durations) + (revise[package] or 0)
+        # Fora do modo em lote os anos do mesmo pacote rodam um depois do outro
+        return sum(durations)
+
+    critical = max(by_package, key=package_path)
+    scheduled = simulate_schedule(jobs)
+    if BATCH_UPLOADS:
+        # Os package_revise só começam depois de todos os jobs, um pacote por vez
+        scheduled += sum(value or 0 for value in revise.values())
+    print()
+    print(f"Jobs: {len(jobs)} em {len(packages)} pacotes ({len(unknown)} sem histórico)")
+    print(f"Requisições: {sum(job['requests'] for job in jobs) + package_requests} "
+          f"(+1 package_create por pacote ainda inexistente)")
+    print(f"Download: {format_mb(sum(job['download_bytes'] or 0 for job in jobs))} MB (recebidos, comprimidos)")
+    print(f"Upload: {format_mb(sum(job['upload_bytes'] or 0 for job in jobs))} MB")
+    print(f"Duração em série: {sum(job['duration'] or 0 for job in jobs):.0f} s")
+    print(f"Duração com {MAX_WORKERS} workers e {MEMORY_BUDGET // MB} MB: {scheduled:.0f} s")
+    if all(job["duration"] is None for job in by_package[critical]):
+        print("Caminho crítico: sem histórico")
+    else:
+        # Os agregados ainda esperam todos os anos do pacote; o upload deles não tem histórico
+        missing_revise = " (package_revise sem histórico)" if BATCH_UPLOADS and revise[critical] is None else ""
+        print(f"Caminho crítico: {critical} ({package_path(critical):.0f} s){missing_revise}")
+
+def main(url_names=None, exercicios=None):
+    jobs, packages, aggregate_targets = plan_jobs(url_names, exercicios)
+    prepare_aggregates(aggregate_targets)
+    results = run_jobs(jobs)
+    publish_aggregates(aggregate_targets, results)
+
+    if BATCH_UPLOADS:
+        upload_packages(packages, results)
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--plan", action="store_true", help="só lista os jobs com as estimativas do histórico")
+    parser.add_argument("--endpoint", action="append", help="url_name do endpoint (pode repetir)")
+    parser.add_argument("--exercicio", action="append", type=int, help="exercício (pode repetir)")
+    commands = parser.add_subparsers(dest="command")
+    enqueue_parser = commands.add_parser("enqueue", help="cria os pacotes e enfileira os jobs em QUEUE_DB")
+    enqueue_parser.add_argument("--wait", action="store_true", help="espera a fila esvaziar e publica os agregados")
+    worker_parser = commands.add_parser("worker", help="processa jobs de QUEUE_DB até a fila esvaziar")
+    worker_parser.add_argument("--id", default=f"{socket.gethostname()}-{os.getpid()}")
+    args = parser.parse_args()
+
+    if args.plan:
+        plan(args.endpoint, args.exercicio)
+    elif args.command == "enqueue":
+        enqueue(args.endpoint, args.exercicio, args.wait)
+    elif args.command == "worker":
+        work(args.id)
+    else:
+        main(args.endpoint, args.exercicio)